@@ -13,28 +13,34 @@
 
 import argparse
 import csv
+import functools
+import json
 import logging
 import os
-import random
 import shlex
 import string
 import sys
+import threading
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from io import StringIO
 from typing import Optional, Sequence, List
 
-import yaml
-from kubernetes import config
+from kubernetes import config, watch
+from kubernetes.client import ApiClient
 from kubernetes.client.api import core_v1_api
 from kubernetes.client.rest import ApiException
-from kubernetes.stream import stream
-from openshift.dynamic import DynamicClient
+from kubernetes.stream import ws_client
+from kubernetes.stream.stream import _websocket_request
 
 LOG = logging.getLogger(__name__)
 
-GPU_CHECK_PROC_PREFIX = 'X-GPUPROC'
+NVIDIA_RESOURCE_PREFIX = 'nvidia.com/'
+
+NODE_POD_WATCH_TIMEOUT = 120
+EXEC_UPDATE_TIMEOUT = 10
 
 
 @dataclass
@@ -63,31 +69,78 @@ class GpuContainer:
     pod_namespace: str
     container_name: str
     node_name: str
+    # List of (host_pid, GpuInfo) tuples
     gpu_usage_list: list
     processes: List[ContainerProcess] = field(default_factory=list)
     host_pid_ns: Optional[str] = None
 
 
+# CoreV1Api with a separate ApiClient for each thread, kubernetes.stream.stream temporarily replaces
+# the request method of the ApiClient and therefore one ApiClient must not be used by parallel exec calls
+class ThreadLocalCoreV1Api(threading.local):
+    def __init__(self, configuration):
+        super().__init__()
+        self._api = core_v1_api.CoreV1Api(ApiClient(configuration=configuration))
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+
+# Read all random bytes at once, the small modulo bias does not matter for unique names
 def randstr(size=10, chars='_' + string.ascii_uppercase + string.ascii_lowercase + string.digits):
-    return ''.join(random.SystemRandom().choice(chars) for _ in range(size))
+    return ''.join(chars[b % len(chars)] for b in os.urandom(size))
 
 
 # https://stackoverflow.com/questions/9535954/printing-lists-as-tabular-data
 def print_table(table: Sequence):
-    longest_cols = [(max([len(str(row[i])) for row in table]) + 1) for i in range(len(table[0]))]
-    row_format = "".join(["{:<" + str(longest_col) + "}" for longest_col in longest_cols])
-    for row in table:
-        print(row_format.format(*row))
+    str_table = [[str(col) for col in row] for row in table]
+    col_widths = [max(map(len, col)) + 1 for col in zip(*str_table)]
+    sys.stdout.write("".join(
+        "".join(col.ljust(width) for col, width in zip(row, col_widths)) + "\n" for row in str_table))
 
 
 def k8s_pod_ready(pod):
-    return (pod.status and pod.status.containerStatuses is not None and
-            all([container.ready for container in pod.status.containerStatuses]))
+    container_statuses = pod.get('status', {}).get('containerStatuses')
+    return (container_statuses is not None and
+            all([container.get('ready') for container in container_statuses]))
+
+
+# Return True if the container requests or limits any resource of the NVIDIA device plugin,
+# e.g. nvidia.com/gpu, nvidia.com/gpu.shared (time-slicing) or nvidia.com/mig-1g.5gb (MIG mixed strategy)
+def k8s_container_requests_gpu(container):
+    resources = container.get('resources')
+    if not resources:
+        return False
+    for resource_list in (resources.get('limits'), resources.get('requests')):
+        if resource_list and any(name.startswith(NVIDIA_RESOURCE_PREFIX) for name in resource_list):
+            return True
+    return False
+
+
+# Yield all items returned by the list function as plain dicts, fetching them page by page with limit and
+# continue token. Response is decoded with json directly, deserializing complete objects into models is slow.
+def k8s_list_items(list_func, limit=500, **kwargs):
+    continue_token = None
+    while True:
+        resp = list_func(limit=limit, _continue=continue_token, _preload_content=False, **kwargs)
+        resource_list = json.loads(resp.data)
+        yield from resource_list.get('items') or []
+        continue_token = resource_list.get('metadata', {}).get('continue')
+        if not continue_token:
+            break
+
+
+# Same as kubernetes.stream.stream, but WSClient does not capture all stdout and stderr data for read_all()
+# in addition to the channel buffers, so output that is read while the command runs is not kept until the end.
+# Depends on the private kubernetes.stream.stream._websocket_request and the capture_all argument of
+# kubernetes.stream.ws_client.websocket_call, see the minimum kubernetes version in requirements.txt.
+k8s_stream = functools.partial(_websocket_request, functools.partial(ws_client.websocket_call, capture_all=False),
+                               None)
 
 
 def k8s_begin_exec(api_instance, pod_name, pod_namespace, command, container=None,
                    stdout=True, stderr=True, stdin=False, tty=False):
-    resp = stream(
+    resp = k8s_stream(
         api_instance.connect_get_namespaced_pod_exec,
         pod_name,
         pod_namespace,
@@ -101,22 +154,24 @@ def k8s_begin_exec(api_instance, pod_name, pod_namespace, command, container=Non
     return resp
 
 
-def k8s_end_exec(resp):
-    stdout, stderr, rc = [], [], 0
-    while resp.is_open():
-        resp.update(timeout=1)
-        if resp.peek_stdout():
-            stdout.append(resp.read_stdout())
-        if resp.peek_stderr():
-            stderr.append(resp.read_stderr())
+# Return exit code of the finished exec from its status channel
+def k8s_exec_returncode(resp):
+    # Status is sent as JSON encoded metav1.Status
     err = resp.read_channel(3)
-    err = yaml.safe_load(err)
+    err = json.loads(err)
     if err['status'] == 'Success':
-        rc = 0
-    else:
-        rc = int(err['details']['causes'][0]['message'])
-    stdout = "".join(stdout)
-    stderr = "".join(stderr)
+        return 0
+    return int(err['details']['causes'][0]['message'])
+
+
+# WSClient.update waits on the socket and appends received data to the channel buffers,
+# so just let it wait until the connection is closed and read the buffers once
+def k8s_end_exec(resp):
+    while resp.is_open():
+        resp.update(timeout=EXEC_UPDATE_TIMEOUT)
+    stdout = resp.read_stdout(timeout=0)
+    stderr = resp.read_stderr(timeout=0)
+    rc = k8s_exec_returncode(resp)
     return stdout, stderr, rc
 
 
@@ -126,6 +181,313 @@ def k8s_exec(api, pod_name, pod_namespace, command, container=None):
     return k8s_end_exec(resp)
 
 
+class K8sExecError(Exception):
+    def __init__(self, rc, stderr):
+        super().__init__('Command failed with exit code {}: {}'.format(rc, stderr))
+        self.rc = rc
+        self.stderr = stderr
+
+
+# Yield stdout lines of the command while they arrive, raise K8sExecError when the command fails
+def k8s_exec_lines(api, pod_name, pod_namespace, command, container=None):
+    resp = k8s_begin_exec(api, pod_name, pod_namespace, command, container,
+                          stdout=True, stderr=True, stdin=False, tty=False)
+    try:
+        stderr = []
+        incomplete_line = ''
+        while resp.is_open():
+            resp.update(timeout=EXEC_UPDATE_TIMEOUT)
+            if resp.peek_stdout():
+                lines = (incomplete_line + resp.read_stdout()).split('\n')
+                incomplete_line = lines.pop()
+                yield from lines
+            if resp.peek_stderr():
+                stderr.append(resp.read_stderr())
+        incomplete_line += resp.read_stdout()
+        if incomplete_line:
+            yield incomplete_line
+        rc = k8s_exec_returncode(resp)
+        if rc != 0:
+            raise K8sExecError(rc, ''.join(stderr))
+    finally:
+        resp.close()
+
+
+# Check the container for GPU usage and list its processes and PID namespace,
+# return GpuContainer or None when the container does not use GPU
+def probe_container(api, pod_name, pod_namespace, pod_node_name, container_name):
+    LOG.info('Checking pod %s with container %s in namespace %s on node %s for GPU usage',
+             pod_name, container_name, pod_namespace, pod_node_name)
+
+    # Query GPU usage, PID namespace and list container processes with a single exec,
+    # PID namespace is the same as the one the processes of the container have on the host
+    table_separator = '===='
+    command = 'sh -c \'' \
+              'nvidia-smi --query-compute-apps=gpu_name,gpu_bus_id,pid,process_name,used_memory ' \
+              '--format=csv,noheader ' \
+              ' && echo "{0}" && ' \
+              'nvidia-smi --query-gpu=index,uuid,serial,pci.bus_id,temperature.gpu,utilization.gpu ' \
+              '--format=csv,noheader ' \
+              ' && echo "{0}" && ' \
+              'readlink /proc/self/ns/pid && echo "{0}" && ' \
+              'for p in /proc/*; do if [ -e "$p/cmdline" ]; then ' \
+              'printf "%s\\t%s\\n" "$p" "$(tr \\\\000\\\\015\\\\012 "   " < "$p/cmdline")"; fi; done' \
+              '\''.format(table_separator)
+
+    try:
+        stdout, stderr, rc = k8s_exec(api, pod_name, pod_namespace, command, container_name)
+        # print('stdout = {}, stderr = {}, rc = {}'.format(stdout, stderr, rc))
+        if rc == 0:
+            if table_separator not in stdout:
+                LOG.error('Unexpected command result, stdout should container separator "{}": %s'
+                          .format(table_separator),
+                          stdout)
+                return None
+
+            print(
+                'Pod {} in namespace {} on node {} uses GPU'.format(pod_name, pod_namespace, pod_node_name),
+                file=sys.stderr)
+
+            # Command line of the listing shell contains the separator as well, split only at the first three
+            nvidia_smi_output = stdout.split(table_separator, 3)
+            if len(nvidia_smi_output) != 4:
+                LOG.error('Unexpected command result, stdout should contain two CSV tables, PID namespace and '
+                          'process list: %s', stdout)
+                return None
+            host_pid_ns = nvidia_smi_output[2].strip()
+
+            f = StringIO(nvidia_smi_output[1].lstrip())
+            reader = csv.reader(f, delimiter=',')
+            gpu_info_map = {}
+            for row in reader:
+                gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization = [s.strip() for s in
+                                                                                          row]
+                gpu_info_map[pci_address] = (
+                gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization)
+
+            f = StringIO(nvidia_smi_output[0])
+            reader = csv.reader(f, delimiter=',')
+            gpu_usage_list = []
+            for row in reader:
+                gpu_name, pci_address, host_pid, proc_name, used_gpu_memory = [s.strip() for s in row]
+                gpu_index = gpu_uuid = gpu_serial = temperature = utilization = None
+                gpu_info = gpu_info_map.get(pci_address)
+                if gpu_info is not None:
+                    gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization = gpu_info
+                if gpu_index is not None:
+                    gpu_index = int(gpu_index)
+
+                gpu_info = GpuInfo(gpu_name, used_gpu_memory, pci_address,
+                                   gpu_index, gpu_uuid, gpu_serial,
+                                   temperature, utilization)
+                gpu_usage_list.append((int(host_pid), gpu_info))
+
+            container_processes = []
+            # NUL, CR and LF characters of the command line are replaced by spaces, so there is one line per
+            # process, but the command line may still contain tabs
+            for line in nvidia_smi_output[3].lstrip().split('\n'):
+                if not line:
+                    continue
+                fields = line.split('\t', 1)
+                if len(fields) < 2:
+                    LOG.error('Unexpected command result, line should contain two tab separated fields: %s',
+                              line)
+                    continue
+                proc_path, cmdline = fields
+                if not proc_path.startswith('/proc/'):
+                    LOG.error('Unexpected command result, string should start with "/proc/": %s',
+                              proc_path)
+                    continue
+                try:
+                    pid = int(proc_path[6:])
+                except ValueError:
+                    # pid is not a number, just ignore
+                    continue
+                container_process = ContainerProcess(pid=pid, cmdline=cmdline)
+                container_processes.append(container_process)
+
+            gpu_container = GpuContainer(pod_name=pod_name,
+                                         pod_namespace=pod_namespace,
+                                         node_name=pod_node_name,
+                                         container_name=container_name,
+                                         gpu_usage_list=gpu_usage_list,
+                                         processes=container_processes,
+                                         host_pid_ns=host_pid_ns)
+            return gpu_container
+        else:
+            LOG.debug('Could not run nvidia-smi in the pod %s container %s, namespace %s',
+                      pod_name, container_name, pod_namespace)
+    except Exception:
+        LOG.exception('Could not exec nvidia-smi in the pod %s container %s, namespace %s',
+                      pod_name, container_name, pod_namespace)
+    return None
+
+
+# Run a host PID namespace pod on the GPU node, list all containerized processes of the node and
+# set host PIDs of the processes of the node's GPU containers.
+# Only containers of this node are modified, so nodes can be probed in parallel.
+def probe_node(api, gpu_node, gpu_node_containers):
+    print('Checking GPU node {} ...'.format(gpu_node), file=sys.stderr)
+    node_pod_name = 'x-gpuproc-{}-{}'.format(
+        randstr(chars=string.ascii_lowercase + string.digits), gpu_node)
+    node_pod_namespace = 'default'
+    node_pod_image = "docker.io/library/alpine"  # "busybox"
+    node_pod_container_name = 'gpucheck'
+    node_pod_manifest = {
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'metadata': {
+            'name': node_pod_name
+        },
+        'spec': {
+            'nodeName': gpu_node,
+            'hostPID': True,
+            # 'hostNetwork': True,
+            'containers': [
+                {
+                    'name': node_pod_container_name,
+                    "securityContext": {
+                        "privileged": True
+                    },
+                    'image': node_pod_image,
+                    "command": ["/bin/sh"],
+                    "args": [
+                        "-c",
+                        "trap exit INT TERM; while true; do sleep 5; done"
+                    ]
+                }
+            ]
+        }
+    }
+    LOG.info('Create GPU checking pod %s on node %s', node_pod_name, gpu_node)
+    try:
+        resp = api.delete_namespaced_pod(node_pod_name, node_pod_namespace)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+
+    while True:
+        try:
+            resp = api.create_namespaced_pod(body=node_pod_manifest,
+                                             namespace=node_pod_namespace)
+            break
+        except ApiException as e:
+            if e.status != 409:  # Conflict
+                raise
+            time.sleep(1)
+
+    try:
+        # Wait until the pod leaves the Pending phase, restart the watch when it times out
+        pod_started = False
+        while not pod_started:
+            pod_watch = watch.Watch()
+            for event in pod_watch.stream(api.list_namespaced_pod, node_pod_namespace,
+                                          field_selector='metadata.name={}'.format(node_pod_name),
+                                          timeout_seconds=NODE_POD_WATCH_TIMEOUT):
+                event_type = event['type']
+                if event_type == 'ERROR':
+                    # Object of an error event is not deserialized, it is a metav1.Status dict
+                    pod_watch.stop()
+                    status = event['raw_object']
+                    raise ApiException(status=status.get('code'),
+                                       reason='Watch of GPU checking pod {} on node {} failed: {}'.format(
+                                           node_pod_name, gpu_node, status.get('message')))
+                if event_type == 'DELETED':
+                    pod_watch.stop()
+                    LOG.error('GPU checking pod %s on node %s was deleted before it started, skip node',
+                              node_pod_name, gpu_node)
+                    return
+                if event_type in ('ADDED', 'MODIFIED') and event['object'].status.phase != 'Pending':
+                    pod_watch.stop()
+                    pod_started = True
+                    break
+
+        LOG.info('Checking GPU node %s with pod %s in namespace %s for GPU usage',
+                 gpu_node, node_pod_name, node_pod_namespace)
+
+        # List only processes of nested PID namespaces, i.e. with more than one NSpid entry,
+        # processes of the host PID namespace can not belong to a container
+        command = 'sh -c \'for p in /proc/[0-9]*; do ' \
+                  'nspid="$(grep NSpid: "$p/status" 2>/dev/null | tr "\\t" " ")"; ' \
+                  'case "$nspid" in *[0-9]" "[0-9]*) printf "%s\\t%s\\t%s\\t%s\\n" "$p" "$(' \
+                  'readlink "$p/ns/pid")" "$nspid" "$(tr \\\\000\\\\015\\\\012 "   " < "$p/cmdline")";; esac; done\' '
+
+        # Containers of a pod with shareProcessNamespace have the same PID namespace
+        pid_ns_to_processes_map = defaultdict(list)
+        for gpu_container in gpu_node_containers:
+            if gpu_container.host_pid_ns:
+                pid_ns_to_processes_map[gpu_container.host_pid_ns].append(
+                    {p.pid: p for p in gpu_container.processes})
+        try:
+            for line in k8s_exec_lines(api, node_pod_name, node_pod_namespace, command, node_pod_container_name):
+                if not line:
+                    continue
+                # Command line is the last field and may contain tabs as well
+                fields = line.split('\t', 3)
+                if len(fields) < 4:
+                    LOG.error('Unexpected command result, line should contain four tab separated fields: %s',
+                              line)
+                    continue
+                proc_path, pid_ns, nspid, cmdline = fields
+                if not pid_ns:
+                    LOG.warning('Pod %s namespace %s on node %s: Missing pid_ns in line: %s',
+                                node_pod_name, node_pod_namespace, gpu_node, line)
+                if not proc_path.startswith('/proc/'):
+                    LOG.error('Unexpected command result, string should start with "/proc/": %s', proc_path)
+                    continue
+                try:
+                    pid = int(proc_path[6:])
+                except ValueError:
+                    # pid is not a number, just ignore
+                    continue
+                # Parse nspid
+                nspid = nspid.strip()
+                if not nspid.startswith('NSpid:'):
+                    LOG.error('Unexpected command result, string should start with "NSpid:": %s', nspid)
+                    continue
+                nspid_list = nspid.split()[1:]
+                try:
+                    nspid_list = [int(i) for i in nspid_list]
+                except ValueError:
+                    LOG.exception('Unexpected command result, NSpid: entry should contain only integers: %s', nspid)
+                    continue
+                if pid != nspid_list[0]:
+                    LOG.error('Unexpected command result, first NSpid id should be equal to PID: %d != %d', pid,
+                              nspid_list[0])
+                    continue
+                if len(nspid_list) > 1:
+                    pid_in_container = nspid_list[1]
+                else:
+                    pid_in_container = None
+
+                # Processes of other containers are dropped here
+                for processes_by_pid in pid_ns_to_processes_map.get(pid_ns, ()):
+                    container_process = processes_by_pid.get(pid_in_container)
+                    if container_process is not None:
+                        container_process.host_pid = pid
+        except K8sExecError as e:
+            LOG.error('Could not get process informations from pod %s container %s, namespace %s on node %s: %s',
+                      node_pod_name, node_pod_container_name, node_pod_namespace, gpu_node, e)
+    finally:
+        try:
+            api.delete_namespaced_pod(node_pod_name, node_pod_namespace)
+        except ApiException as e:
+            # Pod may be already deleted
+            if e.status != 404:
+                raise
+
+
+# Argument type for options that require an integer greater than zero
+def positive_int(value):
+    try:
+        result = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: {!r}'.format(value))
+    if result <= 0:
+        raise argparse.ArgumentTypeError('must be a positive integer: {!r}'.format(value))
+    return result
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Get pod processes that use NVIDIA GPU", formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -139,6 +501,14 @@ def main():
     )
     parser.add_argument("--kubeconfig", default=None, help="Path to the kubeconfig file to use for CLI requests.")
     parser.add_argument("--context", default=None, help="The name of the kubeconfig context to use")
+    parser.add_argument("--label-selector", default=None, help="Check only pods matching this label selector")
+    parser.add_argument("--all-containers", action="store_true",
+                        help="Check also containers that do not request GPU resources, e.g. when GPUs are "
+                             "made available via NVIDIA_VISIBLE_DEVICES")
+    parser.add_argument("--concurrency", type=positive_int, default=16,
+                        help="Number of containers to check in parallel")
+    parser.add_argument("--node-concurrency", type=positive_int, default=8,
+                        help="Number of GPU nodes to check in parallel")
 
     args = parser.parse_args()
 
@@ -164,300 +534,71 @@ def main():
     context = args.context
 
     k8s_client = config.new_client_from_config(config_file=kubeconfig, context=context)
-    dyn_client = DynamicClient(k8s_client)
     api = core_v1_api.CoreV1Api(k8s_client)
+    thread_api = ThreadLocalCoreV1Api(k8s_client.configuration)
 
-    # v1_nodes = dyn_client.resources.get(api_version='v1', kind='Node')
-    #
-    # node_list = v1_nodes.get()
+    # node_list = api.list_node()
     #
     # for node in node_list.items:
     #    print(node.metadata.name)
 
-    pods = dyn_client.resources.get(api_version='v1', kind='Pod')
-
-    pod_list = pods.get(field_selector='status.phase=Running')
-
     gpu_containers: List[GpuContainer] = []
     gpu_node_to_containers_map = defaultdict(list)
-    gpu_containers_map = {}
-
-    exec_processes = {}
 
     print('Search for pods that use GPU...', file=sys.stderr)
 
-    try:
-        for pod in pod_list.items:
-            pod_name = pod.metadata.name
-            pod_namespace = pod.metadata.namespace
-            pod_node_name = pod.spec.nodeName
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        for pod in k8s_list_items(api.list_pod_for_all_namespaces, field_selector='status.phase=Running',
+                                  label_selector=args.label_selector):
+            pod_name = pod['metadata']['name']
+            pod_namespace = pod['metadata']['namespace']
+            pod_node_name = pod['spec'].get('nodeName')
 
             if not k8s_pod_ready(pod):
                 LOG.info('Pod %s in namespace %s is not ready', pod_name, pod_namespace)
                 continue
 
-            for container in pod.spec.containers:
-                LOG.info('Checking pod %s with container %s in namespace %s on node %s for GPU usage',
-                         pod_name, container.name, pod_namespace, pod_node_name)
+            for container in pod['spec']['containers']:
+                if not args.all_containers and not k8s_container_requests_gpu(container):
+                    LOG.info('Container %s of pod %s in namespace %s does not request GPU resources',
+                             container['name'], pod_name, pod_namespace)
+                    continue
+                futures.append(executor.submit(probe_container, thread_api, pod_name, pod_namespace,
+                                               pod_node_name, container['name']))
+
+        # Collect results in submission order so the output does not depend on timing
+        for future in futures:
+            gpu_container = future.result()
+            if gpu_container is None:
+                continue
+            gpu_containers.append(gpu_container)
+            gpu_node_to_containers_map[gpu_container.node_name].append(gpu_container)
 
-                table_separator = '===='
-                command = 'sh -c \'' \
-                          'nvidia-smi --query-compute-apps=gpu_name,gpu_bus_id,pid,process_name,used_memory ' \
-                          '--format=csv,noheader ' \
-                          ' && echo "{}" && ' \
-                          'nvidia-smi --query-gpu=index,uuid,serial,pci.bus_id,temperature.gpu,utilization.gpu ' \
-                          '--format=csv,noheader ' \
-                          '\''.format(table_separator)
+    with ThreadPoolExecutor(max_workers=args.node_concurrency) as executor:
+        node_futures = [(gpu_node, executor.submit(probe_node, thread_api, gpu_node, gpu_node_containers))
+                        for gpu_node, gpu_node_containers in gpu_node_to_containers_map.items()]
 
-                try:
-                    stdout, stderr, rc = k8s_exec(api, pod_name, pod_namespace, command, container.name)
-                    # print('stdout = {}, stderr = {}, rc = {}'.format(stdout, stderr, rc))
-                    if rc == 0:
-                        if table_separator not in stdout:
-                            LOG.error('Unexpected command result, stdout should container separator "{}": %s'
-                                      .format(table_separator),
-                                      stdout)
-                            continue
-
-                        print(
-                            'Pod {} in namespace {} on node {} uses GPU'.format(pod_name, pod_namespace, pod_node_name),
-                            file=sys.stderr)
-
-                        nvidia_smi_output = stdout.split(table_separator)
-                        if len(nvidia_smi_output) != 2:
-                            LOG.error('Unexpected command result, stdout should contain two CSV tables: %s',
-                                      stdout)
-                            continue
-
-                        f = StringIO(nvidia_smi_output[1].lstrip())
-                        reader = csv.reader(f, delimiter=',')
-                        gpu_info_map = {}
-                        for row in reader:
-                            gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization = [s.strip() for s in
-                                                                                                      row]
-                            gpu_info_map[pci_address] = (
-                            gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization)
-
-                        f = StringIO(nvidia_smi_output[0])
-                        reader = csv.reader(f, delimiter=',')
-                        gpu_usage_list = []
-                        for row in reader:
-                            gpu_name, pci_address, host_pid, proc_name, used_gpu_memory = [s.strip() for s in row]
-                            gpu_index = gpu_uuid = gpu_serial = temperature = utilization = None
-                            gpu_info = gpu_info_map.get(pci_address)
-                            if gpu_info is not None:
-                                gpu_index, gpu_uuid, gpu_serial, pci_address, temperature, utilization = gpu_info
-                            if gpu_index is not None:
-                                gpu_index = int(gpu_index)
-
-                            gpu_usage_list.append((gpu_name, pci_address, int(host_pid), proc_name, used_gpu_memory,
-                                                   gpu_index, gpu_uuid, gpu_serial, temperature, utilization))
-
-                        command = 'sh -c \'for p in /proc/*; do if [ -e "$p/cmdline" ]; then ' \
-                                  'printf "%s\\t%s\\n" "$p" "$(tr \\\\0 " " < "$p/cmdline")"; fi; done\' '
-
-                        stdout, stderr, rc = k8s_exec(api, pod_name, pod_namespace, command, container.name)
-                        # print('processes: {} {} {}'.format(stdout, stderr, rc))
-                        if rc == 0:
-                            container_processes = []
-                            for line in stdout.splitlines(keepends=False):
-                                proc_path, cmdline = line.split('\t', maxsplit=1)
-                                if not proc_path.startswith('/proc/'):
-                                    LOG.error('Unexpected command result, string should start with "/proc/": %s',
-                                              proc_path)
-                                    continue
-                                try:
-                                    pid = int(proc_path[6:])
-                                except ValueError:
-                                    # pid is not a number, just ignore
-                                    continue
-                                container_process = ContainerProcess(pid=pid, cmdline=cmdline)
-                                container_processes.append(container_process)
-
-                            gpu_container = GpuContainer(pod_name=pod_name,
-                                                         pod_namespace=pod_namespace,
-                                                         node_name=pod_node_name,
-                                                         container_name=container.name,
-                                                         gpu_usage_list=gpu_usage_list,
-                                                         processes=container_processes)
-                            gpu_containers.append(gpu_container)
-                            gpu_node_to_containers_map[pod_node_name].append(gpu_container)
-
-                            key = '{}|{}|{}|{}|{}|{}'.format(GPU_CHECK_PROC_PREFIX, randstr(),
-                                                             pod_name, pod_namespace, pod_node_name,
-                                                             container.name)
-                            command = 'sh -c "echo \'{}\' && read val"'.format(key)
-                            gpu_containers_map[key] = gpu_container
-
-                            resp = k8s_begin_exec(api, pod_name, pod_namespace, command,
-                                                  container=container.name,
-                                                  stdout=True, stderr=True, stdin=True, tty=False)
-                            exec_processes[key] = resp
-                        else:
-                            LOG.error('Could not get process informations from pod %s container %s, namespace %s',
-                                      pod_name, container.name, pod_namespace)
-                    else:
-                        LOG.debug('Could not run nvidia-smi in the pod %s container %s, namespace %s',
-                                  pod_name, container.name, pod_namespace)
-                except Exception:
-                    LOG.exception('Could not exec nvidia-smi in the pod %s container %s, namespace %s',
-                                  pod_name, container.name, pod_namespace)
-
-        for gpu_node in gpu_node_to_containers_map.keys():
-            print('Checking GPU node {} ...'.format(gpu_node), file=sys.stderr)
-            node_pod_name = 'x-gpuproc-{}-{}'.format(
-                randstr(chars=string.ascii_lowercase + string.digits), gpu_node)
-            node_pod_namespace = 'default'
-            node_pod_image = "docker.io/library/alpine"  # "busybox"
-            node_pod_container_name = 'gpucheck'
-            node_pod_manifest = {
-                'apiVersion': 'v1',
-                'kind': 'Pod',
-                'metadata': {
-                    'name': node_pod_name
-                },
-                'spec': {
-                    'nodeName': gpu_node,
-                    'hostPID': True,
-                    # 'hostNetwork': True,
-                    'containers': [
-                        {
-                            'name': node_pod_container_name,
-                            "securityContext": {
-                                "privileged": True
-                            },
-                            'image': node_pod_image,
-                            "command": ["/bin/sh"],
-                            "args": [
-                                "-c",
-                                "trap exit INT TERM; while true; do sleep 5; done"
-                            ]
-                        }
-                    ]
-                }
-            }
-            LOG.info('Create GPU checking pod %s on node %s', node_pod_name, gpu_node)
+        # Propagate exceptions raised while probing the nodes, stop at the first API error,
+        # probes that already started are finished and remove their pods
+        for gpu_node, future in node_futures:
             try:
-                resp = api.delete_namespaced_pod(node_pod_name, node_pod_namespace)
+                future.result()
             except ApiException as e:
-                if e.status != 404:
-                    LOG.exception('Unexpected error')
-                    sys.exit(1)
+                for _, node_future in node_futures:
+                    node_future.cancel()
+                LOG.error('Checking GPU node %s failed: %s', gpu_node, e)
+                return 1
 
-            while True:
-                try:
-                    resp = api.create_namespaced_pod(body=node_pod_manifest,
-                                                     namespace=node_pod_namespace)
-                    break
-                except ApiException as e:
-                    if e.status != 409:  # Conflict
-                        LOG.exception('Unexpected error')
-                        sys.exit(1)
-                    time.sleep(1)
-
-            while True:
-                resp = api.read_namespaced_pod(name=node_pod_name,
-                                               namespace=node_pod_namespace)
-                if resp.status.phase != 'Pending':
-                    break
-                time.sleep(1)
-
-            LOG.info('Checking GPU node %s with pod %s in namespace %s for GPU usage',
-                     gpu_node, node_pod_name, node_pod_namespace)
-
-            command = 'sh -c \'for p in /proc/*; do if [ -e "$p/cmdline" ]; then printf "%s\\t%s\\t%s\\t%s\\n" "$p" "$(' \
-                      'readlink "$p/ns/pid")" "$(grep NSpid: "$p/status" | tr "\\t" " ")" "$(tr \\\\0 " " < ' \
-                      '"$p/cmdline")"; fi; done\' '
-
-            stdout, stderr, rc = k8s_exec(api, node_pod_name, node_pod_namespace, command, node_pod_container_name)
-            # print('processes: {} {} {}'.format(stdout, stderr, rc))
-            if rc == 0:
-                host_process_information = []
-                pid_ns_to_container_map = {}
-                for line in stdout.splitlines(keepends=False):
-                    proc_path, pid_ns, nspid, cmdline = line.split('\t')
-                    if not pid_ns:
-                        LOG.warning('Pod %s namespace %s on node %s: Missing pid_ns in line: %s',
-                                    node_pod_name, node_pod_namespace, gpu_node, line)
-                    if not proc_path.startswith('/proc/'):
-                        LOG.error('Unexpected command result, string should start with "/proc/": %s', proc_path)
-                        continue
-                    try:
-                        pid = int(proc_path[6:])
-                    except ValueError:
-                        # pid is not a number, just ignore
-                        continue
-                    # Parse nspid
-                    nspid = nspid.strip()
-                    if not nspid.startswith('NSpid:'):
-                        LOG.error('Unexpected command result, string should start with "NSpid:": %s', nspid)
-                        continue
-                    nspid_list = nspid.split()[1:]
-                    try:
-                        nspid_list = [int(i) for i in nspid_list]
-                    except ValueError:
-                        LOG.exception('Unexpected command result, NSpid: entry should contain only integers: %s', nspid)
-                        continue
-                    if pid != nspid_list[0]:
-                        LOG.error('Unexpected command result, first NSpid id should be equal to PID: %d != %d', pid,
-                                  nspid_list[0])
-                        continue
-                    if len(nspid_list) > 1:
-                        pid_in_container = nspid_list[1]
-                    else:
-                        pid_in_container = None
-                    if GPU_CHECK_PROC_PREFIX in cmdline:
-                        container_key = None
-                        for param in shlex.split(cmdline):
-                            if param.startswith(GPU_CHECK_PROC_PREFIX):
-                                container_key = param
-                                break
-                        if container_key is None:
-                            raise Exception(
-                                'Internal error, could not parse parameter with prefix {} from command line {}'
-                                    .format(GPU_CHECK_PROC_PREFIX, cmdline))
-                        gpu_container = gpu_containers_map.get(container_key)
-                        gpu_container.host_pid_ns = pid_ns
-                        pid_ns_to_container_map[pid_ns] = gpu_container
-                    host_process_information.append((pid, pid_ns, pid_in_container, cmdline))
-                # Post-process process information
-                for pinfo in host_process_information:
-                    pid, pid_ns, pid_in_container, cmdline = pinfo
-                    gpu_container = pid_ns_to_container_map.get(pid_ns)
-                    if gpu_container is not None:
-                        for container_process in gpu_container.processes:
-                            if container_process.pid == pid_in_container:
-                                container_process.host_pid = pid
-                                break
-                # Post process gpu containers
-                for gpu_container in gpu_containers:
-                    for gpu_usage in gpu_container.gpu_usage_list:
-                        (gpu_name, pci_address, host_pid, proc_name, used_gpu_memory,
-                         gpu_index, gpu_uuid, gpu_serial, temperature, utilization) = gpu_usage
-                        gpu_info = GpuInfo(gpu_name, used_gpu_memory, pci_address,
-                                           gpu_index, gpu_uuid, gpu_serial,
-                                           temperature, utilization)
-                        for container_process in gpu_container.processes:
-                            if container_process.host_pid == host_pid:
-                                if gpu_info not in container_process.gpu_infos:
-                                    container_process.gpu_infos.append(gpu_info)
-
-            else:
-                LOG.error('Could not get process informations from pod %s container %s, namespace %s on node %s',
-                          node_pod_name, node_pod_container_name, node_pod_namespace, gpu_node)
-
-            resp = api.delete_namespaced_pod(node_pod_name, node_pod_namespace)
-    finally:
-        print('Cleanup...', file=sys.stderr)
-        # Stop all processes
-        for key, resp in exec_processes.items():
-            # End process by providing input for the read command
-            try:
-                resp.write_stdin('\n')
-                stdout, stderr, rc = k8s_end_exec(resp)
-                LOG.info('Finished process with ID %s, rc: %s', key, rc)
-            except Exception:
-                LOG.exception('Could not end exec for process with ID %s', key)
+    # Post process gpu containers
+    for gpu_container in gpu_containers:
+        processes_by_host_pid = {p.host_pid: p for p in gpu_container.processes if p.host_pid is not None}
+        for host_pid, gpu_info in gpu_container.gpu_usage_list:
+            container_process = processes_by_host_pid.get(host_pid)
+            if container_process is None:
+                continue
+            if gpu_info not in container_process.gpu_infos:
+                container_process.gpu_infos.append(gpu_info)
 
     # pp = pprint.PrettyPrinter(indent=4)
     # pp.pprint(gpu_node_to_containers_map)